@@ -4,17 +4,23 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
-import math
 
 MOTOR_MIN_TIME = 0.100
 
+# sx1509 I_ON register value indexed by int(255 * duty); non-inverted pins
+# take the complemented value
+_DUTY_LUT = bytes(range(256))
+_DUTY_LUT_INVERTED = bytes((~i) & 0xFF for i in range(256))
+
 class Drv8833Motor:
     def __init__(self, config, default_shutdown_speed=0.):
         self.printer = config.get_printer()
         self.last_speed_a = 0.
         self.last_speed_b = 0.
+        self.last_motor_velocity = 0.
         self.last_decay_mode = 'fast'
         self.last_motor_time = 0.
+        self._last_requested_velocity = 0.
         # Read config
         self.max_power = config.getfloat('max_power', 1., above=0., maxval=1.)
         self.kick_start_speed = config.getfloat('kick_start_speed', self.max_power, above=0., maxval=1.)
@@ -23,6 +29,15 @@ class Drv8833Motor:
         hardware_pwm = config.getboolean('hardware_pwm', False)
         shutdown_speed = config.getfloat(
             'shutdown_speed', default_shutdown_speed, minval=0., maxval=1.)
+        self._decay_modes = ('fast', 'slow')
+        # (decay_mode, sign) -> speed -> (speed_a, speed_b, ks_a, ks_b)
+        ks = self.kick_start_speed
+        self._decay_table = {
+            ('fast', 1): lambda s: (s, 0, ks, 0),
+            ('fast', -1): lambda s: (0, s, 0, ks),
+            ('slow', 1): lambda s: (1, 1 - s, 1, 1 - ks),
+            ('slow', -1): lambda s: (1 - s, 1, 1 - ks, 1),
+        }
         # Setup pwm object
         ppins = self.printer.lookup_object('pins')
         self.mcu_motor_a = ppins.setup_pin('pwm', config.get('pin_a'))
@@ -60,24 +75,50 @@ class Drv8833Motor:
         return self._sx1509._i2c
 
     def build_config(self):
-        if not hasattr(self._i2c, "i2c_write_batch_cmd"):
-          self._i2c.i2c_write_batch_cmd = self.mcu.lookup_command(
-              "i2c_write_batch oid=%c chunks=%*s data=%*s", cq=self._i2c.cmd_queue)
+        i2c = self._i2c
+        if not hasattr(i2c, "i2c_write_batch_cmd"):
+          i2c.i2c_write_batch_cmd = self.mcu.lookup_command(
+              "i2c_write_batch oid=%c chunks=%*s data=%*s", cq=i2c.cmd_queue)
+        # Resolve the batch command and bus oid once for _send_registers
+        self._i2c_write_batch_cmd = i2c.i2c_write_batch_cmd
+        self._i2c_oid = i2c.oid
+        # Static register layout of the batch write: the I_ON register byte
+        # is fixed, only the value byte read from the sx1509 changes
+        sx1509 = self._sx1509
+        tx_template = []
+        self._tx_chunks = []
+        self._reg_layout = []
+        for m in (self.mcu_motor_a, self.mcu_motor_b):
+            reg = m._i_on_reg
+            if reg not in sx1509.reg_i_on_dict:
+                raise self.printer.config_error(
+                    "drv8833_motor %s: pin register 0x%02x is not an sx1509"
+                    " I_ON register" % (self.motor_name, reg))
+            self._reg_layout.append((len(tx_template) + 1, reg))
+            tx_template += [reg & 0xFF, 0]
+            self._tx_chunks.append(2)
+        # Reused for every send; the encoder copies it out immediately
+        self._tx_data = bytearray(tx_template)
+        self._sx1509_i_on_values = sx1509.reg_i_on_dict
+        # Per-motor PWM register parameters for set_ab_speed
+        self._set_register = sx1509.set_register
+        self._motor_pwm_params = tuple(
+            (m._i_on_reg, _DUTY_LUT if m._invert else _DUTY_LUT_INVERTED)
+            for m in (self.mcu_motor_a, self.mcu_motor_b))
 
     def set_speed(self, print_time, velocity, decay_mode):
-        velocity = math.copysign(max(0., min(self.max_power, abs(velocity) * self.max_power)), velocity)
+        if (velocity == self._last_requested_velocity
+                and decay_mode == self.last_decay_mode):
+            return
+        requested_velocity = velocity
+        mp = self.max_power
+        sign = -1 if velocity < 0 else 1
+        speed = min(mp, abs(velocity) * mp)
+        velocity = sign * speed
         if velocity == self.last_motor_velocity and decay_mode == self.last_decay_mode:
+            self._last_requested_velocity = requested_velocity
             return
-        speed = abs(velocity)
-        if decay_mode == 'fast':
-            speed_a, speed_b = speed, 0
-            ks_a, ks_b = self.kick_start_speed, 0
-        else:
-            speed_a, speed_b = 1, 1 - speed
-            ks_a, ks_b = 1, 1 - self.kick_start_speed
-        if velocity < 0:
-            speed_a, speed_b = speed_b, speed_a
-            ks_a, ks_b = ks_b, ks_a
+        speed_a, speed_b, ks_a, ks_b = self._decay_table[(decay_mode, sign)](speed)
 
         print_time = max(self.last_motor_time + MOTOR_MIN_TIME, print_time)
         if (speed and self.kick_start_time and abs(velocity - self.last_motor_velocity) > .5):
@@ -86,6 +127,7 @@ class Drv8833Motor:
         self.set_ab_speed(print_time, speed_a, speed_b)
         self.last_motor_time = print_time
         self.last_decay_mode = decay_mode
+        self._last_requested_velocity = requested_velocity
     
     def ab_to_velocity(self, a, b):
         if b == 0:
@@ -99,36 +141,23 @@ class Drv8833Motor:
         else:
             return None
     
-    @property
-    def last_motor_velocity(self):
-        return self.ab_to_velocity(self.last_speed_a, self.last_speed_b)
-    
     def set_ab_speed(self, print_time, a, b):
-        self._set_pwm(self.mcu_motor_b, b)
-        self._set_pwm(self.mcu_motor_a, a)
+        set_register = self._set_register
+        (reg_a, lut_a), (reg_b, lut_b) = self._motor_pwm_params
+        set_register(reg_b, lut_b[int(255 * b)])
+        set_register(reg_a, lut_a[int(255 * a)])
         self._send_registers(print_time)
         self.last_speed_a = a
         self.last_speed_b = b
-
-    def _set_pwm(self, motor, value):
-        self._sx1509.set_register(motor._i_on_reg, ~int(255 * value)
-                                  if not motor._invert
-                                  else int(255 * value) & 0xFF)
+        self.last_motor_velocity = self.ab_to_velocity(a, b)
     
     def _send_registers(self, print_time):
-        regs = [m._i_on_reg for m in (self.mcu_motor_a, self.mcu_motor_b)]
-        data = []
-        for reg in regs:
-          data += [reg & 0xFF]
-          if reg in self._sx1509.reg_dict:
-              # Word
-              data += [(self._sx1509.reg_dict[reg] >> 8) & 0xFF,
-                       self._sx1509.reg_dict[reg] & 0xFF]
-          elif reg in self._sx1509.reg_i_on_dict:
-              # Byte
-              data += [self._sx1509.reg_i_on_dict[reg] & 0xFF]
+        data = self._tx_data
+        values = self._sx1509_i_on_values
+        for offset, reg in self._reg_layout:
+            data[offset] = values[reg] & 0xFF
         clock = self.mcu.print_time_to_clock(print_time)
-        self._i2c.i2c_write_batch_cmd.send([self._i2c.oid, [2, 2], data], 
+        self._i2c_write_batch_cmd.send([self._i2c_oid, self._tx_chunks, data],
                 minclock=self._sx1509._last_clock, reqclock=clock)
         self._sx1509._last_clock = clock
 
@@ -136,7 +165,9 @@ class Drv8833Motor:
     cmd_SET_MOTOR_VELOCITY_help = "Sets the velocity of a DC motor"
     def cmd_SET_MOTOR_VELOCITY(self, gcmd):
         velocity = gcmd.get_float('VELOCITY', 0.)
-        decay_mode = gcmd.get('DECAY_MODE', default='fast')
+        decay_mode = gcmd.get('DECAY_MODE', default='fast').lower()
+        if decay_mode not in self._decay_modes:
+            raise gcmd.error("Unknown DECAY_MODE '%s'" % (decay_mode,))
         toolhead = self.printer.lookup_object('toolhead')
         toolhead.register_lookahead_callback((lambda pt:
                                               self.set_speed(pt, velocity, decay_mode)))
@@ -3,28 +3,26 @@
 # Copyright (C) 2024 Cambridge Yang <camyang@csail.mit.edu>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
+import logging
 
-import contextlib
-
-
-@contextlib.contextmanager
-def patch_method(obj, method_name, new_method):
-  """Handler to temporarily match a method of an object, and restore it afterwards
-  It takes care of exception handling and restoring the original method
-  """
-  old_method = getattr(obj, method_name)
-  setattr(obj, method_name,
-          lambda *args, **kwargs: new_method(old_method, *args, **kwargs))
-  try:
-    yield
-  finally:
-    setattr(obj, method_name, old_method)
+_mmu_trace_filament_move = None
 
+_REWIND_CONTROL_TEMPLATES = {
+  mode: "REWINDER_CONTROL ID=%%d MODE=%s" % mode
+  for mode in ("rewind_fast", "rewind_slow", "load_fast", "load_slow", "stop")
+}
 
-_mmu_unload_bowden = None
-_mmu_unload_gate = None
-_mmu_load_bowden = None
-_mmu_trace_filament_move = None
+# trace_str -> (rewind mode during move, wait for moves after)
+# TODO: handle case without gate sensor
+_TRACE_ACTIONS = {
+  "Course unloading move from bowden": ("rewind_fast", False),
+  "Reverse homing to extruder sensor": ("rewind_slow", False),
+  "Reverse homing to toolhead sensor": ("rewind_slow", False),
+  "Bowden pre-unload test": ("rewind_slow", False),
+  "Reverse homing to gate sensor": ("rewind_slow", False),
+  "Unloading extruder": ("rewind_slow", False),
+  "Final parking": ("rewind_slow", True),
+}
 
 
 class MmuRewinderPatch:
@@ -33,43 +31,73 @@ class MmuRewinderPatch:
     self.printer = config.get_printer()
     self.mmu = self.printer.lookup_object('mmu')
     self.gcode = self.printer.lookup_object('gcode')
+    self._run_script = self.gcode.run_script_from_command
+    self._num_rewinders = 0
+    self._last_mode = {}
+    self._scripts = {}
+    self.printer.register_event_handler("klippy:connect", self.handle_connect)
     self._patch_mmu()
 
+  def handle_connect(self):
+    # One rewinder per gate; resolved once the MMU has its gate map
+    self._num_rewinders = len(self.mmu.gate_status)
+    self._scripts = {
+      (idx, mode): template % idx
+      for idx in range(self._num_rewinders)
+      for mode, template in _REWIND_CONTROL_TEMPLATES.items()
+    }
+
   def _patch_mmu(self):
     global _mmu_trace_filament_move
     _mmu_trace_filament_move = self.mmu._trace_filament_move
     self.mmu._trace_filament_move = self._trace_filament_move
 
   def _trace_filament_move(self, trace_str, *args, **kwargs):
-    if trace_str == "Course unloading move from bowden":
-      self.rewind_control("rewind_fast")
-      ret = _mmu_trace_filament_move(trace_str, *args, **kwargs)
-      self.rewind_control("stop")
-    elif trace_str in ("Reverse homing to extruder sensor", "Reverse homing to toolhead sensor", "Bowden pre-unload test", "Reverse homing to gate sensor", "Unloading extruder", "Final parking", "Bowden pre-unload test"):  # TODO: handle case without gate sensor
-      self.rewind_control("rewind_slow")
-      ret = _mmu_trace_filament_move(trace_str, *args, **kwargs)
-      self.rewind_control("stop")
-      if trace_str == "Final parking":
-          self.mmu._movequeues_wait_moves()
-    elif trace_str == "Course loading move into bowden":
-      if self.mmu.gate_selected >= 0 and self.mmu.gate_status[self.mmu.gate_selected] != self.mmu.GATE_AVAILABLE_FROM_BUFFER:
-        self.rewind_control("load_slow")
-        ret = _mmu_trace_filament_move(trace_str, *args, **kwargs)
-        self.rewind_control("stop")
+    action = _TRACE_ACTIONS.get(trace_str)
+    if action is not None:
+      mode, wait_moves = action
+      ret = self._with_rewind(mode, trace_str, args, kwargs)
+      if wait_moves:
+        self.mmu._movequeues_wait_moves()
+      return ret
+    if trace_str == "Course loading move into bowden":
+      mmu = self.mmu
+      gate = mmu.gate_selected
+      # gate_status is rebound by the MMU on gate map changes, read it each time
+      if gate >= 0 and mmu.gate_status[gate] != mmu.GATE_AVAILABLE_FROM_BUFFER:
+        mode = "load_slow"
       else:
-        self.rewind_control("load_fast")
-        ret = _mmu_trace_filament_move(trace_str, *args, **kwargs)
-        self.rewind_control("stop")
-    else:
+        mode = "load_fast"
+      return self._with_rewind(mode, trace_str, args, kwargs)
+    return _mmu_trace_filament_move(trace_str, *args, **kwargs)
+
+  def _with_rewind(self, mode, trace_str, args, kwargs):
+    """Run the traced move with the rewinder in mode, stopping it afterwards"""
+    self.rewind_control(mode)
+    try:
       ret = _mmu_trace_filament_move(trace_str, *args, **kwargs)
+    except BaseException:
+      # Best effort stop; the move's own error must reach the MMU
+      try:
+        self.rewind_control("stop")
+      except Exception:
+        logging.exception("mmu_rewinder_patch: failed to stop rewinder")
+      raise
+    self.rewind_control("stop")
     return ret
 
   def rewind_control(self, mode):
     """Control the rewind motor"""
     rewinder_idx = self.mmu.gate_selected
-    if type(rewinder_idx) is int:
-      self.gcode.run_script_from_command("REWINDER_CONTROL ID=%d MODE=%s" %
-                                         (rewinder_idx, mode))
+    # Unknown (-1) and bypass (-2) gates have no rewinder
+    if rewinder_idx is None or not 0 <= rewinder_idx < self._num_rewinders:
+      return
+    if self._last_mode.get(rewinder_idx) == mode:
+      return
+    # Forget the old mode first so a failing script leaves no stale entry
+    self._last_mode.pop(rewinder_idx, None)
+    self._run_script(self._scripts[(rewinder_idx, mode)])
+    self._last_mode[rewinder_idx] = mode
 
 
 def load_config(config):